@@ -66,6 +66,21 @@ def default() -> ml_collections.ConfigDict:
           # split the local energy into pieces to save memory
           'el_partition_num': 0,
           'forward_laplacian': True,
+          # Only used if forward_laplacian is False. 0: loop over the basis
+          # vectors; k > 0: vmap over k trunks of basis vectors.
+          'laplacian_partition_num': 0,
+          # Used if laplacian_partition_num is 0. 0: no unrolling; -1: fully
+          # unroll the loop; k > 0: unroll a lax.scan k times. Faster, but
+          # slower to compile.
+          'laplacian_unroll': 0,
+          # One of linop, jacfwd_diag (full Hessian, small systems only).
+          'laplacian_hessian_mode': 'linop',
+          # If positive, estimate the laplacian with Hutchinson's trace
+          # estimator using this many random vectors per walker.
+          'n_hte_vec': 0,
+          'hte_method': 'unit',  # one of unit (Rademacher), normal, sdgd
+          # Evaluate the Hutchinson Hessian-vector products in bfloat16.
+          'low_prec_kinetic': False,
           'lr': {
               'warmup': 0,
               'rate': 0.05,  # learning rate
@@ -15,13 +15,16 @@
 
 """Evaluating the Hamiltonian on a wavefunction."""
 
-from typing import Any, Sequence
+import functools
+from typing import Any, Optional, Sequence, Tuple, Union
 
 import chex
 from lapnet import networks
 import jax
 from jax import lax
 import jax.numpy as jnp
+from lapjax import LapTuple, TupType
+import numpy as np
 from typing_extensions import Protocol
 
 
@@ -37,6 +40,18 @@ class LocalEnergy(Protocol):
     """
 
 
+class SplitLocalEnergy(Protocol):
+
+  def __call__(self, params: networks.ParamTree, key: chex.PRNGKey,
+               data: jnp.ndarray) -> Tuple[jnp.ndarray, jnp.ndarray]:
+    """Returns the potential and kinetic energy at a configuration.
+    Args:
+      params: network parameters.
+      key: JAX PRNG state.
+      data: MCMC configuration to evaluate.
+    """
+
+
 class MakeLocalEnergy(Protocol):
 
   def __call__(self,
@@ -59,62 +74,182 @@ class MakeLocalEnergy(Protocol):
     """
 
 
+def get_random_vec(rng: chex.PRNGKey, dim: int, n_vec: int,
+                   method: str = 'unit') -> jnp.ndarray:
+  """Returns random vectors v with E[v v^T] = I for Hutchinson's estimator.
+
+  Args:
+    rng: JAX PRNG state.
+    dim: Dimension of each vector. Must be a static integer.
+    n_vec: Number of vectors. Must be a static integer.
+    method: 'unit': Rademacher (+1/-1 entries); 'normal': standard Gaussian;
+      'sdgd': sqrt(dim) times distinct coordinate basis vectors, i.e.
+      stochastic dimension gradient descent. Requires n_vec <= dim.
+
+  Returns:
+    Array of shape (n_vec, dim).
+  """
+  if method == 'unit':
+    return (2 * jax.random.randint(rng, (n_vec, dim), 0, 2) - 1).astype(
+        jnp.float32)
+  elif method == 'normal':
+    return jax.random.normal(rng, (n_vec, dim))
+  elif method == 'sdgd':
+    idx = jax.random.choice(rng, dim, (n_vec,), replace=False)
+    return jnp.zeros((n_vec, dim)).at[jnp.arange(n_vec), idx].set(
+        jnp.sqrt(float(dim)))
+  else:
+    raise ValueError(f'Unknown method: {method}.')
+
+
 def local_kinetic_energy(
     f: networks.LogWaveFuncLike,
     use_scan: bool = False,
-    forward_laplacian=True) -> networks.LogWaveFuncLike:
+    forward_laplacian=True,
+    partition_num: int = 0,
+    unroll: int = 0,
+    hessian_mode: str = 'linop',
+    n_hte_vec: int = 0,
+    hte_method: str = 'unit',
+    low_prec_kinetic: bool = False) -> networks.LogWaveFuncLike:
   r"""Creates a function to for the local kinetic energy, -1/2 \nabla^2 ln|f|.
 
   Args:
     f: Callable which evaluates the log of the magnitude of the wavefunction.
     use_scan: Whether to use a `lax.scan` for computing the laplacian.
+    forward_laplacian: Whether to use the forward laplacian (LapJAX).
     partition_num: 0: fori_loop implementation
-                   1: Hessian implementation
-                   other positive integer: Split the laplacian to multiple trunks and
-                                           calculate accordingly.
+                   1: vmap over all basis vectors at once
+                   other positive integer: Split the basis vectors into
+                                           partition_num trunks, vmap within a
+                                           trunk and loop over the trunks.
+    unroll: Only used if partition_num is 0. -1: unroll the loop over the
+      basis vectors in Python; positive integer k: use a `lax.scan` unrolled
+      k times; 0: no unrolling. Unrolling increases compilation time, which
+      grows linearly with the number of coordinates, but gives XLA a fused
+      graph that runs faster.
+    hessian_mode: How the exact laplacian is computed if forward_laplacian is
+      False. 'linop': apply the linearized gradient to each basis vector, as
+      controlled by use_scan, partition_num and unroll; 'jacfwd_diag': build
+      the full Hessian with `jax.jacfwd` and take its trace. The latter needs
+      O(n^2) memory, so only use it for small systems.
+    n_hte_vec: If positive, estimate the laplacian with Hutchinson's trace
+      estimator (HTE) using n_hte_vec random vectors per configuration instead
+      of computing it exactly.
+    hte_method: Distribution of the HTE random vectors. 'unit': Rademacher
+      (+1/-1 entries), which has the lowest variance; 'normal': standard
+      Gaussian; 'sdgd': randomly chosen coordinate directions. See
+      get_random_vec.
+    low_prec_kinetic: If true, evaluate the HTE Hessian-vector products in
+      bfloat16 and average them in float32. Only used if n_hte_vec is
+      positive. Determinants are still computed in float32 (see
+      networks.network_blocks.slogdet) and the gradient term at full
+      precision.
 
   Returns:
     Callable which evaluates the local kinetic energy,
     -1/2f \nabla^2 f = -1/2 (\nabla^2 log|f| + (\nabla log|f|)^2).
+    The signature is ke(params, data, key) if n_hte_vec is positive and
+    ke(params, data) otherwise.
   """
+  if hessian_mode not in ('linop', 'jacfwd_diag'):
+    raise ValueError(f'Unknown hessian_mode: {hessian_mode}.')
+  if hte_method not in ('unit', 'normal', 'sdgd'):
+    raise ValueError(f'Unknown hte_method: {hte_method}.')
+  if unroll < -1:
+    raise ValueError(f'unroll must be -1, 0 or positive, got {unroll}.')
+  if low_prec_kinetic and n_hte_vec == 0:
+    raise ValueError('low_prec_kinetic requires n_hte_vec > 0.')
 
   def _forward_lapl_over_f(params, data):
-      from lapjax import LapTuple, TupType
       output = f(params, LapTuple(data, is_input=True))
       return -0.5 * output.get(TupType.LAP) - \
               0.5 * jnp.sum(output.get(TupType.GRAD)**2)
 
   def _lapl_over_f(params, data):
     n = data.shape[0]
-    eye = jnp.eye(n)
+    # Build the i-th basis vector on the fly rather than slicing jnp.eye(n).
+    basis_vec = lambda i: jnp.zeros(n, data.dtype).at[i].set(1.0)
     grad_f = jax.grad(f, argnums=1)
     grad_f_closure = lambda y: grad_f(params, y)
+
+    if hessian_mode == 'jacfwd_diag':
+      def grad_f_with_aux(y):
+        grad = grad_f_closure(y)
+        return grad, grad
+      hessian, primal = jax.jacfwd(grad_f_with_aux, has_aux=True)(data)
+      return -0.5 * jnp.trace(hessian) - 0.5 * jnp.sum(primal ** 2)
+
     primal, dgrad_f = jax.linearize(grad_f_closure, data)
 
-    if use_scan:
+    if partition_num > 0:
+      if n % partition_num:
+        raise ValueError(f'partition_num={partition_num} must divide the '
+                         f'number of coordinates ({n}).')
+      batch_diag = jax.vmap(lambda i: dgrad_f(basis_vec(i))[i])
+      idx = jnp.arange(n).reshape(partition_num, -1)
+      diagonal = lax.map(batch_diag, idx)
+      result = -0.5 * jnp.sum(diagonal)
+    elif unroll == -1:
+      result = -0.5 * sum(dgrad_f(basis_vec(i))[i] for i in range(n))
+    elif use_scan or unroll > 0:
       _, diagonal = lax.scan(
-          lambda i, _: (i + 1, dgrad_f(eye[i])[i]), 0, None, length=n)
+          lambda i, _: (i + 1, dgrad_f(basis_vec(i))[i]), 0, None, length=n,
+          unroll=max(unroll, 1))
       result = -0.5 * jnp.sum(diagonal)
     else:
       result = -0.5 * lax.fori_loop(
-          0, n, lambda i, val: val + dgrad_f(eye[i])[i], 0.0)
+          0, n, lambda i, val: val + dgrad_f(basis_vec(i))[i], 0.0)
     return result - 0.5 * jnp.sum(primal ** 2)
 
-  if forward_laplacian:
+  random_vec = functools.partial(
+      get_random_vec, n_vec=n_hte_vec, method=hte_method)
+
+  def _randomized_lapl_over_f(params, data, key):
+    rand_vec = random_vec(key, data.shape[0]).astype(data.dtype)
+    if low_prec_kinetic:
+      to_bf16 = lambda x: (x.astype(jnp.bfloat16)
+                           if jnp.issubdtype(x.dtype, jnp.floating) else x)
+      hvp_params = jax.tree_util.tree_map(to_bf16, params)
+      hvp_data, rand_vec = to_bf16(data), to_bf16(rand_vec)
+    else:
+      hvp_params, hvp_data = params, data
+    grad_f = jax.grad(f, argnums=1)
+    grad_f_closure = lambda y: grad_f(hvp_params, y)
+    # Forward-over-reverse rather than jax.experimental.jet, which has no rule
+    # for the LU decomposition in slogdet.
+    primal, dgrad_f = jax.linearize(grad_f_closure, hvp_data)
+    hvps = jax.vmap(lambda v: jnp.dot(v, dgrad_f(v)))(rand_vec)
+    if low_prec_kinetic:
+      trace_est = jnp.mean(hvps.astype(jnp.float32)).astype(data.dtype)
+      # The gradient term is not a stochastic estimate, so keep it exact.
+      primal = grad_f(params, data)
+    else:
+      trace_est = jnp.mean(hvps)
+    return -0.5 * (trace_est + jnp.sum(primal ** 2))
+
+  if n_hte_vec > 0:
+    return _randomized_lapl_over_f
+  elif forward_laplacian:
     return _forward_lapl_over_f
   else:
     return _lapl_over_f
 
 
-def potential_electron_electron(r_ee: jnp.ndarray) -> jnp.ndarray:
+def potential_electron_electron(
+    r_ee: jnp.ndarray,
+    iu: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> jnp.ndarray:
   """Returns the electron-electron potential.
 
   Args:
     r_ee: Shape (neletrons, nelectrons, :). r_ee[i,j,0] gives the distance
       between electrons i and j. Other elements in the final axes are not
       required.
+    iu: Precomputed np.triu_indices(nelectrons, k=1). Computed if not given.
   """
-  return jnp.sum(jnp.triu(1 / r_ee[..., 0], k=1))
+  if iu is None:
+    iu = np.triu_indices(r_ee.shape[0], k=1)
+  return jnp.sum(1.0 / r_ee[iu[0], iu[1], 0])
 
 
 def potential_electron_nuclear(charges: jnp.ndarray,
@@ -129,21 +264,30 @@ def potential_electron_nuclear(charges: jnp.ndarray,
   return -jnp.sum(charges / r_ae[..., 0])
 
 
-def potential_nuclear_nuclear(charges: jnp.ndarray,
-                              atoms: jnp.ndarray) -> jnp.ndarray:
+def potential_nuclear_nuclear(
+    charges: jnp.ndarray,
+    atoms: jnp.ndarray,
+    iu: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> jnp.ndarray:
   """Returns the electron-nuclearpotential.
 
   Args:
     charges: Shape (natoms). Nuclear charges of the atoms.
     atoms: Shape (natoms, ndim). Positions of the atoms.
+    iu: Precomputed np.triu_indices(natoms, k=1). Computed if not given.
   """
-  r_aa = jnp.linalg.norm(atoms[None, ...] - atoms[:, None], axis=-1)
-  return jnp.sum(
-      jnp.triu((charges[None, ...] * charges[..., None]) / r_aa, k=1))
-
-
-def potential_energy(r_ae: jnp.ndarray, r_ee: jnp.ndarray, atoms: jnp.ndarray,
-                     charges: jnp.ndarray) -> jnp.ndarray:
+  if iu is None:
+    iu = np.triu_indices(atoms.shape[0], k=1)
+  r_aa = jnp.linalg.norm(atoms[iu[0]] - atoms[iu[1]], axis=-1)
+  return jnp.sum((charges[iu[0]] * charges[iu[1]]) / r_aa)
+
+
+def potential_energy(
+    r_ae: jnp.ndarray,
+    r_ee: jnp.ndarray,
+    atoms: jnp.ndarray,
+    charges: jnp.ndarray,
+    iu_ee: Optional[Tuple[np.ndarray, np.ndarray]] = None,
+    iu_aa: Optional[Tuple[np.ndarray, np.ndarray]] = None) -> jnp.ndarray:
   """Returns the potential energy for this electron configuration.
 
   Args:
@@ -154,10 +298,12 @@ def potential_energy(r_ae: jnp.ndarray, r_ee: jnp.ndarray, atoms: jnp.ndarray,
       required.
     atoms: Shape (natoms, ndim). Positions of the atoms.
     charges: Shape (natoms). Nuclear charges of the atoms.
+    iu_ee: Precomputed upper-triangular indices of the electron pairs.
+    iu_aa: Precomputed upper-triangular indices of the atom pairs.
   """
-  return (potential_electron_electron(r_ee) +
+  return (potential_electron_electron(r_ee, iu_ee) +
           potential_electron_nuclear(charges, r_ae) +
-          potential_nuclear_nuclear(charges, atoms))
+          potential_nuclear_nuclear(charges, atoms, iu_aa))
 
 
 def local_energy(f: networks.WaveFuncLike,
@@ -165,7 +311,15 @@ def local_energy(f: networks.WaveFuncLike,
                  charges: jnp.ndarray,
                  nspins: Sequence[int],
                  use_scan: bool = False,
-                 forward_laplacian=True) -> LocalEnergy:
+                 forward_laplacian=True,
+                 partition_num: int = 0,
+                 unroll: int = 0,
+                 hessian_mode: str = 'linop',
+                 n_hte_vec: int = 0,
+                 hte_method: str = 'unit',
+                 low_prec_kinetic: bool = False,
+                 split_output: bool = False
+                 ) -> Union[LocalEnergy, SplitLocalEnergy]:
   """Creates the function to evaluate the local energy.
 
   Args:
@@ -175,30 +329,83 @@ def local_energy(f: networks.WaveFuncLike,
     charges: Shape (natoms). Nuclear charges of the atoms.
     nspins: Number of particles of each spin.
     use_scan: Whether to use a `lax.scan` for computing the laplacian.
+    forward_laplacian: Whether to use the forward laplacian (LapJAX) to compute
+      the kinetic energy.
+    partition_num: Number of trunks the basis vectors are split into when
+      computing the laplacian without the forward laplacian. See
+      local_kinetic_energy.
+    unroll: How many times to unroll the loop over the basis vectors when
+      partition_num is 0; -1 unrolls it fully. See local_kinetic_energy.
+    hessian_mode: Either 'linop' or 'jacfwd_diag'. See local_kinetic_energy.
+    n_hte_vec: If positive, number of random vectors used to estimate the
+      laplacian with Hutchinson's trace estimator.
+    hte_method: Distribution of the random vectors, one of 'unit'
+      (Rademacher), 'normal' or 'sdgd'. See get_random_vec.
+    low_prec_kinetic: Whether to evaluate the Hutchinson estimator in
+      bfloat16. The potential energy is unaffected.
+    split_output: If true, e_l returns the tuple (potential, kinetic) instead
+      of their sum. The result is then a SplitLocalEnergy rather than a
+      LocalEnergy and cannot be passed to loss.make_loss.
 
   Returns:
     Callable with signature e_l(params, key, data) which evaluates the local
     energy of the wavefunction given the parameters params, RNG state key,
-    and a single MCMC configuration in data.
+    and a single MCMC configuration in data. The callable is jitted, so the
+    input features, potential and kinetic terms are traced and fused into a
+    single XLA computation. Further transformations (vmap, grad, pmap) should
+    be applied around the returned callable rather than to its pieces.
   """
-  del nspins
+  nelectrons = sum(nspins)
+  ndim = atoms.shape[-1]
+  # partition_num is only read by the linearized exact laplacian.
+  if (partition_num > 0 and not forward_laplacian and n_hte_vec == 0 and
+      hessian_mode == 'linop' and (nelectrons * ndim) % partition_num):
+    raise ValueError(f'partition_num={partition_num} must divide the number '
+                     f'of electron coordinates ({nelectrons * ndim}).')
+  if hte_method == 'sdgd' and n_hte_vec > nelectrons * ndim:
+    raise ValueError(f'n_hte_vec={n_hte_vec} must not exceed the number of '
+                     f'electron coordinates ({nelectrons * ndim}) when '
+                     'hte_method is sdgd.')
+  # Pair indices only depend on the (fixed) numbers of electrons and atoms.
+  iu_ee = np.triu_indices(nelectrons, k=1)
+  iu_aa = np.triu_indices(atoms.shape[0], k=1)
+  # The nuclear repulsion does not depend on the electron positions.
+  e_nn = potential_nuclear_nuclear(charges, atoms, iu_aa)
   log_abs_f = lambda *args, **kwargs: f(*args, **kwargs)[1]
   ke = local_kinetic_energy(log_abs_f, use_scan=use_scan,
-                            forward_laplacian=forward_laplacian)
-
+                            forward_laplacian=forward_laplacian,
+                            partition_num=partition_num,
+                            unroll=unroll,
+                            hessian_mode=hessian_mode,
+                            n_hte_vec=n_hte_vec,
+                            hte_method=hte_method,
+                            low_prec_kinetic=low_prec_kinetic)
+
+  @jax.jit
   def _e_l(params: networks.ParamTree, key: chex.PRNGKey,
-           data: jnp.ndarray) -> jnp.ndarray:
-    """Returns the total energy.
+           data: jnp.ndarray
+           ) -> Union[jnp.ndarray, Tuple[jnp.ndarray, jnp.ndarray]]:
+    """Returns the total energy, or (potential, kinetic) if split_output.
 
     Args:
       params: network parameters.
       key: RNG state.
       data: MCMC configuration.
     """
-    del key  # unused
+    # Shapes are static under jit, so this only runs when tracing. A different
+    # shape would otherwise silently trigger a recompilation.
+    if data.shape[-1] != nelectrons * ndim:
+      raise ValueError(f'Expected {nelectrons * ndim} electron coordinates, '
+                       f'got {data.shape[-1]}.')
     _, _, r_ae, r_ee = networks.construct_input_features(data, atoms)
-    potential = potential_energy(r_ae, r_ee, atoms, charges)
-    kinetic = ke(params, data)
+    potential = (potential_electron_electron(r_ee, iu_ee) +
+                 potential_electron_nuclear(charges, r_ae) + e_nn)
+    if n_hte_vec > 0:
+      kinetic = ke(params, data, key)
+    else:
+      kinetic = ke(params, data)
+    if split_output:
+      return potential, kinetic
     return potential + kinetic
 
   return _e_l
@@ -82,7 +82,7 @@ def make_loss(network: networks.LogWaveFuncLike,
   """
   batch_local_energy = jax.vmap(local_energy, in_axes=(None, 0, 0), out_axes=0)
   batch_network = jax.vmap(network, in_axes=(None, 0), out_axes=0)
-  batch_local_energy_with_param = lambda params, data: (params, batch_local_energy(params, None, data))
+  batch_local_energy_with_param = lambda params, x: (params, batch_local_energy(params, *x))
 
   def pmean_with_mask(value, mask):
     '''
@@ -119,7 +119,8 @@ def make_loss(network: networks.LogWaveFuncLike,
     if el_partition > 0 :
       btz = data.shape[0] // el_partition
       data = data.reshape((-1,btz)+data.shape[1:])
-      _,e_l = jax.lax.scan(batch_local_energy_with_param, params, data)
+      keys = keys.reshape((-1,btz)+keys.shape[1:])
+      _,e_l = jax.lax.scan(batch_local_energy_with_param, params, (keys, data))
       e_l = e_l.reshape(-1)
     else:
       e_l = batch_local_energy(params, keys, data)
@@ -98,6 +98,10 @@ def slogdet(x):
   Returns:
     sign, (natural) logarithm of the determinant of x.
   """
+  if not isinstance(x, LapTuple) and x.dtype == jax.numpy.bfloat16:
+    # The LAPACK/cuSOLVER LU decompositions only support single and double
+    # precision.
+    x = x.astype(jax.numpy.float32)
   if x.shape[-1] == 1:
     sign = jnp.sign(x[..., 0, 0])
     logdet = jnp.log(jnp.abs(x[..., 0, 0]))
@@ -442,7 +442,13 @@ def train(cfg: ml_collections.ConfigDict, writer_manager=None):
         charges=charges,
         nspins=nspins,
         use_scan=False,
-        forward_laplacian=cfg.optim.forward_laplacian)
+        forward_laplacian=cfg.optim.forward_laplacian,
+        partition_num=cfg.optim.laplacian_partition_num,
+        unroll=cfg.optim.laplacian_unroll,
+        hessian_mode=cfg.optim.laplacian_hessian_mode,
+        n_hte_vec=cfg.optim.n_hte_vec,
+        hte_method=cfg.optim.hte_method,
+        low_prec_kinetic=cfg.optim.low_prec_kinetic)
   total_energy = qmc_loss_functions.make_loss(
       network,
       local_energy,